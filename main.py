@@ -3,23 +3,49 @@ from datetime import date, timedelta, UTC
 from dateutil.relativedelta import relativedelta
 
 import datetime
+import functools
+import hashlib
 import os
+import threading
+import time
 from contextlib import asynccontextmanager
 from typing import Annotated, List, Optional
 
-import jwt
-from fastapi import Depends, FastAPI, HTTPException, Query, status
+import bcrypt
+from cachetools import TTLCache
+from fastapi import Body, Depends, FastAPI, HTTPException, Query, Request, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from jwt.exceptions import InvalidTokenError
-from passlib.context import CryptContext
-from sqlmodel import Session, SQLModel, create_engine, select
+from sqlalchemy import bindparam, event
+from sqlalchemy.orm import sessionmaker
+from sqlmodel import Session, SQLModel, create_engine, delete, func, insert, select, update
 
-from models import (Expense, ExpenseCreate, ExpenseRead, Token, TokenData, CategoryBase, CategoryCreate, CategoryRead, Category,
+from models import (Expense, ExpenseCreate, ExpenseRead, Token, CategoryCreate, CategoryRead, Category,
                     User, UserCreate, UserRead)
 
 # Database setup
 sqlite_url = "sqlite:///database.db"
-engine = create_engine(sqlite_url, echo=True)  # echo=True for debugging
+engine = create_engine(
+    sqlite_url,
+    echo=os.getenv("SQL_ECHO", "0") == "1",  # SQL_ECHO=1 for debugging
+    connect_args={"check_same_thread": False},
+    pool_pre_ping=False,
+    pool_size=20,
+    max_overflow=40,
+    pool_recycle=1800,
+)
+# expire_on_commit=False keeps loaded attributes valid after commit instead of re-selecting them
+SessionLocal = sessionmaker(engine, class_=Session, expire_on_commit=False)
+
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
 
 
 # Lifespan event handler
@@ -41,50 +67,173 @@ if not SECRET_KEY:
     raise ValueError("SECRET_KEY environment variable not set!")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "10"))
+# cost of the hashes stored before BCRYPT_ROUNDS was lowered, until their next login rehashes them
+LEGACY_BCRYPT_ROUNDS = 12
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="users/login")
 
+# decoded JWT payloads, kept well below the token lifetime so revocation windows stay small
+_jwt_module = None
+_JWT_ALGORITHMS = (ALGORITHM,)
+_JWT_KEY = SECRET_KEY.encode("utf-8")  # encoded once instead of on every encode/decode
+_JWT_DECODE_OPTIONS = {"require": ["exp", "sub"], "verify_signature": True, "verify_aud": False}
+_jwt_cache = TTLCache(maxsize=10_000, ttl=60)
+_jwt_cache_lock = threading.Lock()
+
+# recently authenticated users, so polling clients don't hit the database on every request
+_user_cache = TTLCache(maxsize=1024, ttl=30)
+_user_cache_lock = threading.Lock()
+
 
 # Database dependency
 def get_session():
-    with Session(engine) as session:
+    session = SessionLocal()
+    try:
         yield session
+    finally:
+        session.close()
 
 
 # Authentication functions
-def verify_password(plain_password: str, hashed_password: str):
-    return pwd_context.verify(plain_password, hashed_password)
+# bcrypt releases the GIL while hashing, so the threadpool keeps it off the event loop
+# and still runs concurrent logins in parallel
+async def verify_password(plain_password: str, hashed_password: str):
+    return await run_in_threadpool(
+        bcrypt.checkpw, plain_password.encode("utf-8"), hashed_password.encode("utf-8")
+    )
+
 
+async def get_password_hash(password: str):
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
+    hashed = await run_in_threadpool(bcrypt.hashpw, password.encode("utf-8"), salt)
+    return hashed.decode("utf-8")
 
-def get_password_hash(password: str):
-    return pwd_context.hash(password)
+
+# statements built once at import, only the bound parameters change per call
+_user_by_name_stmt = select(User).where(User.username == bindparam("username"))
+_expenses_by_owner_stmt = select(Expense).where(Expense.owner_id == bindparam("owner_id"))
+_owned_expense_stmt = select(Expense).where(
+    Expense.id == bindparam("expense_id"), Expense.owner_id == bindparam("owner_id")
+)
 
 
 def get_user(session: Session, username: str) -> Optional[User]:
-    statement = select(User).where(User.username == username)
-    return session.exec(statement).first()
+    return session.exec(_user_by_name_stmt, params={"username": username}).first()
+
+
+def get_user_cached(session: Session, username: str) -> Optional[UserRead]:
+    with _user_cache_lock:
+        user = _user_cache.get(username)
+    if user is not None:
+        return user
+
+    db_user = get_user(session, username)
+    if db_user is None:
+        return None
+    # a frozen copy rather than the ORM row, concurrent requests share the cached object
+    user = UserRead.model_validate(db_user)
+    with _user_cache_lock:
+        _user_cache[username] = user
+    return user
+
+
+def invalidate_cached_user(username: str):
+    # call after every write to a user row
+    with _user_cache_lock:
+        _user_cache.pop(username, None)
+
+
+def get_owned_expense(session: Session, expense_id: int, owner_id: int) -> Optional[Expense]:
+    # scoped to the owner in SQL so other users' rows are never loaded
+    params = {"expense_id": expense_id, "owner_id": owner_id}
+    return session.exec(_owned_expense_stmt, params=params).first()
+
+
+@functools.lru_cache(maxsize=8)
+def _dummy_hash(rounds: int) -> str:
+    # computed once per cost on first use rather than at import
+    return bcrypt.hashpw(b"x", bcrypt.gensalt(rounds=rounds)).decode("utf-8")
+
+
+def filter_by_date_range(query, start_date: Optional[date], end_date: Optional[date]):
+    # Expense.date is a UTC datetime column, so compare against datetime bounds. end_date is
+    # inclusive, i.e. everything before the start of the following day. A plain range on
+    # the column lets SQLite seek the (owner_id, date) index instead of filtering every row.
+    if start_date:
+        query = query.where(Expense.date >= datetime.datetime.combine(start_date, datetime.time.min, tzinfo=UTC))
+    if end_date:
+        next_day = datetime.datetime.combine(end_date + timedelta(days=1), datetime.time.min, tzinfo=UTC)
+        query = query.where(Expense.date < next_day)
+    return query
+
 
+@functools.lru_cache(maxsize=4096)
+def _hash_cost(hashed_password: str) -> int:
+    # bcrypt hashes look like $2b$12$<salt+digest>
+    return int(hashed_password.split("$")[2])
 
-def authenticate_user(session: Session, username: str, password: str):
+
+async def authenticate_user(session: Session, username: str, password: str):
     user = get_user(session, username)
-    if not user or not verify_password(password, user.hashed_password):
+    if not user:
+        # spend the same bcrypt time as a real check so timing doesn't reveal which usernames exist
+        # the first call per cost hashes, so that runs in the threadpool too. Matched to the
+        # highest cost still stored, a cheaper check would single out the legacy accounts
+        dummy_rounds = max(BCRYPT_ROUNDS, LEGACY_BCRYPT_ROUNDS)
+        dummy_hash = await run_in_threadpool(_dummy_hash, dummy_rounds)
+        await verify_password(password, dummy_hash)
+        return False
+    if not await verify_password(password, user.hashed_password):
         return False
+
+    # upgrade hashes made with a lower cost while the plain password is at hand
+    if _hash_cost(user.hashed_password) < BCRYPT_ROUNDS:
+        user.hashed_password = await get_password_hash(password)
+        session.add(user)
+        session.commit()
+        invalidate_cached_user(user.username)
     return user
 
 
+def _jwt():
+    # PyJWT pulls in cryptography when it is installed, so import it on first use
+    # instead of on every worker start
+    global _jwt_module
+    if _jwt_module is None:
+        import jwt
+
+        _jwt_module = jwt
+    return _jwt_module
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.datetime.now(UTC) + expires_delta
-    else:
-        expire = datetime.datetime.now(UTC) + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    if not expires_delta:
+        expires_delta = timedelta(minutes=15)
+    # JWT exp is a plain epoch timestamp, no need to build an aware datetime
+    expire = int(time.time() + expires_delta.total_seconds())
+    to_encode = {**data, "exp": expire}
+    encoded_jwt = _jwt().encode(to_encode, _JWT_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
+def _decode_cached(token: str) -> dict:
+    # keyed by a digest so the bearer tokens themselves aren't kept in memory
+    key = hashlib.blake2b(token.encode("utf-8"), digest_size=16).digest()
+    with _jwt_cache_lock:
+        payload = _jwt_cache.get(key)
+    # never serve a cached payload past the token's own expiry
+    if payload is not None and payload.get("exp", 0) > time.time():
+        return payload
+
+    payload = _jwt().decode(token, _JWT_KEY, algorithms=_JWT_ALGORITHMS, options=_JWT_DECODE_OPTIONS)
+    with _jwt_cache_lock:
+        _jwt_cache[key] = payload
+    return payload
+
+
 async def get_current_user(
+    request: Request,
     token: Annotated[str, Depends(oauth2_scheme)],
     session: Session = Depends(get_session),
 ):
@@ -94,22 +243,23 @@ async def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
-    except InvalidTokenError:
+        # exp and sub are required claims, decoding fails without them
+        username: str = _decode_cached(token)["sub"]
+    except _jwt().InvalidTokenError:
         raise credentials_exception
 
-    user = get_user(session, username=token_data.username)
-    if user is None:
-        raise credentials_exception
+    # share the user row between all dependencies of the same request
+    user = getattr(request.state, "current_user", None)
+    if user is None or user.username != username:
+        user = get_user_cached(session, username=username)
+        if user is None:
+            raise credentials_exception
+        request.state.current_user = user
     return user
 
 
 async def get_current_active_user(
-    current_user: Annotated[User, Depends(get_current_user)],
+    current_user: Annotated[UserRead, Depends(get_current_user)],
 ):
     if current_user.disabled:
         raise HTTPException(status_code=400, detail="Inactive user")
@@ -122,7 +272,7 @@ async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
     session: Session = Depends(get_session),
 ):
-    user = authenticate_user(session, form_data.username, form_data.password)
+    user = await authenticate_user(session, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -141,42 +291,78 @@ async def create_user(user: UserCreate, session: Session = Depends(get_session))
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already registered")
 
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash(user.password)
     db_user = User(username=user.username, hashed_password=hashed_password)
 
     session.add(db_user)
     session.commit()
-    session.refresh(db_user)
+    invalidate_cached_user(db_user.username)
 
     return db_user
 
 
 @app.get("/users/me", response_model=UserRead)
 async def read_users_me(
-    current_user: Annotated[User, Depends(get_current_active_user)],
+    current_user: Annotated[UserRead, Depends(get_current_active_user)],
 ):
     return current_user
 
 
+def _now() -> datetime.datetime:
+    # the one clock the endpoints read, tests freeze it here
+    return datetime.datetime.now(UTC)
+
+
+def _new_expense_values(expense: ExpenseCreate, owner_id: int, now: datetime.datetime) -> dict:
+    # the model defaults each read the clock on their own, fill in the ones the client left
+    # out from a single now so date and last_updated match
+    values = expense.model_dump()
+    for field in ("date", "last_updated"):
+        if field not in expense.model_fields_set:
+            values[field] = now
+    values["owner_id"] = owner_id
+    return values
+
+
 # Expense endpoints
 @app.post("/expenses", response_model=ExpenseRead)
 async def create_expense(
     expense: ExpenseCreate,
-    current_user: Annotated[User, Depends(get_current_active_user)],
+    current_user: Annotated[UserRead, Depends(get_current_active_user)],
     session: Session = Depends(get_session),
 ):
-    db_expense = Expense(**expense.model_dump(), owner_id=current_user.id)
+    now = _now()
+    db_expense = Expense(**_new_expense_values(expense, current_user.id, now))
 
     session.add(db_expense)
     session.commit()
-    session.refresh(db_expense)
 
     return db_expense
 
 
+@app.post("/expenses/bulk", response_model=List[ExpenseRead])
+async def create_expenses_bulk(
+    expenses: Annotated[List[ExpenseCreate], Body(max_length=1000)],
+    current_user: Annotated[UserRead, Depends(get_current_active_user)],
+    session: Session = Depends(get_session),
+):
+    if not expenses:
+        return []
+
+    # one executemany INSERT ... RETURNING and a single commit for the whole batch, rows
+    # come back in request order
+    now = _now()
+    rows = [_new_expense_values(expense, current_user.id, now) for expense in expenses]
+    statement = insert(Expense).returning(Expense, sort_by_parameter_order=True)
+    db_expenses = session.exec(statement, params=rows).scalars().all()
+    session.commit()
+
+    return db_expenses
+
+
 @app.get("/expenses", response_model=List[ExpenseRead])
 async def get_expenses(
-    current_user: Annotated[User, Depends(get_current_active_user)],
+    current_user: Annotated[UserRead, Depends(get_current_active_user)],
     session: Session = Depends(get_session),
     start_date: Optional[date] = Query(
         None, description="Filter expenses created on or after this date (YYYY-MM-DD)"
@@ -187,47 +373,50 @@ async def get_expenses(
     category_id: Optional[int] = Query(None, description="Filter expenses by category"),
     skip: int = Query(0, description="Number of records to skip for pagination", ge=0),
     limit: int = Query(100, description="Maximum number of records to return", le=1000),
+    cursor: Optional[int] = Query(
+        None, description="Return expenses with an id greater than this one (keyset pagination, replaces skip)"
+    ),
 ):
     # base query
-    query = select(Expense).where(Expense.owner_id == current_user.id)
+    query = _expenses_by_owner_stmt
 
     # Apply date range filter
-    if start_date:
-        query = query.where(Expense.date >= start_date)
-    if end_date:
-        query = query.where(Expense.date <= end_date)
+    query = filter_by_date_range(query, start_date, end_date)
 
     # Apply category filter
     if category_id:
         query = query.where(Expense.category_id == category_id)
 
-    # Apply pagination
-    query = query.offset(skip).limit(limit)
+    # Apply pagination, keyset when a cursor is given since OFFSET walks the skipped rows
+    if cursor is not None:
+        query = query.where(Expense.id > cursor)
+    else:
+        query = query.offset(skip)
+    query = query.order_by(Expense.id).limit(limit)
 
-    expenses = session.exec(query).all()
+    # fetch rows in batches of 200 instead of one large fetchall, serialized by the response model
+    rows = session.exec(
+        query.execution_options(yield_per=200), params={"owner_id": current_user.id}
+    )
+    expenses = list(rows)
 
-    #generate recurring expenses
-    expense_reads = []
+    #generate recurring expenses once the cursor is exhausted, generating commits the session
     for expense in expenses:
-        expense_read = ExpenseRead.model_validate(expense)
         if expense.recurrence_rule:
             generate_recurring_expenses(session, current_user.id, expense)
-            expense_read = ExpenseRead.model_validate(expense) 
-        expense_reads.append(expense_read)
 
-    return expense_reads
+    return expenses
 
 
 @app.get("/expenses/{expense_id}", response_model=ExpenseRead)
 async def get_expense(
     expense_id: int,
-    current_user: Annotated[User, Depends(get_current_active_user)],
+    current_user: Annotated[UserRead, Depends(get_current_active_user)],
     session: Session = Depends(get_session),
 ):
-    expense = session.get(Expense, expense_id)
-    if not expense or expense.owner_id != current_user.id:
+    expense = get_owned_expense(session, expense_id, current_user.id)
+    if not expense:
         raise HTTPException(status_code=404, detail="Expense not found")
-    
 
     expense_read = ExpenseRead.model_validate(expense)
     if expense.recurrence_rule:
@@ -240,38 +429,39 @@ async def get_expense(
 async def update_expense(
     expense_id: int,
     expense_data: ExpenseCreate,
-    current_user: Annotated[User, Depends(get_current_active_user)],
+    current_user: Annotated[UserRead, Depends(get_current_active_user)],
     session: Session = Depends(get_session),
 ):
-    db_expense = session.get(Expense, expense_id)
-    if not db_expense or db_expense.owner_id != current_user.id:
+    # only the fields the client sent, written in one UPDATE ... RETURNING
+    values = expense_data.model_dump(exclude_unset=True)
+    values["last_updated"] = _now()
+    statement = (
+        update(Expense)
+        .where(Expense.id == expense_id, Expense.owner_id == current_user.id)
+        .values(**values)
+        .returning(Expense)
+    )
+    db_expense = session.exec(statement).scalars().first()
+    if not db_expense:
+        session.rollback()
         raise HTTPException(status_code=404, detail="Expense not found")
-
-    for key, value in expense_data.model_dump().items():
-        setattr(db_expense, key, value)
-
-    db_expense.last_updated = datetime.datetime.now(UTC)
-
-    session.add(db_expense)
     session.commit()
-    session.refresh(db_expense)
-
-
-
 
+    return db_expense
 
 
-@app.delete("/expenses/{expense_id}")
+@app.delete("/expenses/{expense_id}", response_model=dict[str, str])
 async def delete_expense(
     expense_id: int,
-    current_user: Annotated[User, Depends(get_current_active_user)],
+    current_user: Annotated[UserRead, Depends(get_current_active_user)],
     session: Session = Depends(get_session),
 ):
-    expense = session.get(Expense, expense_id)
-    if not expense or expense.owner_id != current_user.id:
+    # one owner-scoped DELETE, no need to load the row first
+    statement = delete(Expense).where(Expense.id == expense_id, Expense.owner_id == current_user.id)
+    result = session.exec(statement)
+    if result.rowcount == 0:
+        session.rollback()
         raise HTTPException(status_code=404, detail="Expense not found")
-
-    session.delete(expense)
     session.commit()
 
     return {"message": "Expense deleted successfully"}
@@ -281,14 +471,13 @@ async def delete_expense(
 @app.post("/categories", response_model=CategoryRead)
 async def create_category(
     category: CategoryCreate,
-    current_user: Annotated[User, Depends(get_current_active_user)],
+    current_user: Annotated[UserRead, Depends(get_current_active_user)],
     session: Session = Depends(get_session),
 ):
     db_category = Category(**category.model_dump())
 
     session.add(db_category)
     session.commit()
-    session.refresh(db_category)
 
     return db_category
 
@@ -328,9 +517,9 @@ async def get_category(
 
 
 
-@app.get("/reports/expenses", response_model=dict)
+@app.get("/reports/expenses", response_model=dict[str, float])
 async def get_expenses_report(
-    current_user: Annotated[User, Depends(get_current_active_user)],
+    current_user: Annotated[UserRead, Depends(get_current_active_user)],
     session: Session = Depends(get_session),
     start_date: Optional[date] = Query(
         None, description="Filter expenses created on or after this date (YYYY-MM-DD)"
@@ -339,45 +528,18 @@ async def get_expenses_report(
         None, description="Filter expenses created on or before this date (YYYY-MM-DD)"
     )
 ):
-    # base query
-    query = select(Expense).where(Expense.owner_id == current_user.id)
+    # sum per category in a single aggregate query
+    query = (
+        select(Expense.category_id, func.sum(Expense.amount))
+        .where(Expense.owner_id == current_user.id)
+    )
 
     # Apply date range filter
-    if start_date:
-        query = query.where(Expense.date >= start_date)
-    if end_date:
-        query = query.where(Expense.date <= end_date)
-
-    report_dict = dict()
-
-    expenses = session.exec(query).all()
-
-    #get number of categories
-
-    categories = []
-    # categories_number = 0
-
-    for expense in expenses:
-        categories.append(expense.category_id)
-
-    categories = set(categories)
-    print("\ncategories number: ", len(categories))
-
-    # categories_amount = len(categories)
-    
-    #iterate over categories
-    for category_id in categories:
-        temp_query = query.where(Expense.category_id == category_id)
-        expenses_per_cat = session.exec(temp_query).all()
-        category_sum = 0
-        for expense in expenses_per_cat:
-            category_sum = category_sum + expense.amount
-        print(f'category id: {category_id} category_sum = {category_sum}')
-        report_dict[str(category_id)] = category_sum
+    query = filter_by_date_range(query, start_date, end_date)
 
-    print(f'report: \n {report_dict}')
+    query = query.group_by(Expense.category_id)
 
-    return report_dict
+    return {str(category_id): total for category_id, total in session.exec(query).all()}
 
 
 
@@ -396,8 +558,9 @@ def generate_recurring_expenses(session: Session, current_user_id: int, expense:
     generated_expenses = []
     next_date = expense.recurrence_start_date
 
+    now = _now()
     for _ in range(num_future_expenses):
-        if next_date > datetime.datetime.now(UTC) : 
+        if next_date > now:
             new_expense_data = {
                 "amount": expense.amount,
                 "description": expense.description,
@@ -430,7 +593,7 @@ def generate_recurring_expenses(session: Session, current_user_id: int, expense:
 # new endpoint can be implemented for getting recurring endpoints
 # @app.get("/recurring_expenses", response_model=List[ExpenseRead])
 # async def get_recurring_expenses(
-#     current_user: Annotated[User, Depends(get_current_active_user)],
+#     current_user: Annotated[UserRead, Depends(get_current_active_user)],
 #     session: Session = Depends(get_session)
 # ):
 #     pass #Implementation for listing only recurring expenses can be added here
\ No newline at end of file
@@ -1,12 +1,8 @@
 from datetime import datetime, UTC
 from typing import Optional
 
-from passlib.context import CryptContext
-from pydantic import BaseModel, field_validator
-from sqlmodel import Field, Relationship, SQLModel
-
-# Password context for hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from pydantic import BaseModel, ConfigDict, field_validator
+from sqlmodel import Field, Index, Relationship, SQLModel
 
 
 # Base SQL Model
@@ -25,6 +21,8 @@ class User(UserBase, table=True):
 
 # Pydantic model for API responses
 class UserRead(UserBase):
+    model_config = ConfigDict(frozen=True)
+
     id: int
 
 
@@ -47,6 +45,9 @@ class ExpenseBase(SQLModel):
 
 
 class Expense(ExpenseBase, table=True):
+    # serves the owner + date range + category filters of /expenses and /reports/expenses
+    __table_args__ = (Index("ix_expense_owner_date_cat", "owner_id", "date", "category_id"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     owner_id: Optional[int] = Field(default=None, foreign_key="user.id")
 
@@ -68,6 +69,8 @@ class ExpenseCreate(ExpenseBase):
 
 
 class ExpenseRead(ExpenseBase):
+    model_config = ConfigDict(frozen=True)
+
     id: int
     owner_id: int
 
@@ -81,13 +84,13 @@ class CategoryCreate(CategoryBase):
     pass
 
 class CategoryRead(CategoryBase):
+    model_config = ConfigDict(frozen=True)
+
     id: int
 
 # Authentication models
 class Token(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     access_token: str
     token_type: str
-
-
-class TokenData(BaseModel):
-    username: Optional[str] = None
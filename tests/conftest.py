@@ -1,37 +1,181 @@
+import httpx
 import pytest
-from fastapi.testclient import TestClient
-from sqlmodel import Session, SQLModel, create_engine
+from sqlalchemy import event
+from sqlalchemy.orm import raiseload
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine, select
 
+import main
 from main import app, get_session
+from models import Category, Expense, User
 
-# Set default async fixture scope
-pytestmark = pytest.mark.asyncio(scope="function")
+# Test database setup, in-memory so nothing touches the disk; StaticPool keeps the one
+# connection (and with it the schema) alive across the threadpool workers. Every xdist
+# worker is its own process and so gets its own database.
+engine = create_engine(
+    "sqlite://",
+    echo=True,
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
 
-# Test database setup
-TEST_DATABASE_URL = "sqlite:///./test.db"
-engine = create_engine(TEST_DATABASE_URL, echo=True)
 
+# pysqlite's implicit transaction handling breaks SAVEPOINT, let SQLAlchemy emit BEGIN itself
+@event.listens_for(engine, "connect")
+def disable_pysqlite_transactions(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
 
-# Override the database dependency
-def override_get_session():
-    with Session(engine) as session:
-        yield session
 
+@event.listens_for(engine, "begin")
+def emit_begin(conn):
+    conn.exec_driver_sql("BEGIN")
 
-@pytest.fixture(autouse=True)
+
+@pytest.fixture(scope="session", autouse=True)
 def setup_db():
-    # Create all tables before each test
+    # Create all tables once for the whole run
     SQLModel.metadata.create_all(engine)
     yield
-    # Drop all tables after each test
     SQLModel.metadata.drop_all(engine)
 
 
+@pytest.fixture(name="connection")
+def connection_fixture():
+    # Each test runs inside one outer transaction that is rolled back afterwards,
+    # the commits made by the app only release savepoints inside it
+    connection = engine.connect()
+    transaction = connection.begin()
+    yield connection
+    transaction.rollback()
+    connection.close()
+
+
+class GuardedSession(Session):
+    pass
+
+
+# Stand-in for nplusone: relationships loaded by a test session raise on lazy load, so a
+# response touching e.g. expense.owner fails the test instead of issuing one query per row
+@event.listens_for(GuardedSession, "do_orm_execute")
+def raise_on_lazy_load(orm_execute_state):
+    if (
+        orm_execute_state.is_select
+        and not orm_execute_state.is_column_load
+        and not orm_execute_state.is_relationship_load
+    ):
+        orm_execute_state.statement = orm_execute_state.statement.options(
+            raiseload("*")
+        )
+
+
+def _test_session(connection):
+    return GuardedSession(
+        bind=connection,
+        expire_on_commit=False,
+        join_transaction_mode="create_savepoint",
+    )
+
+
+@pytest.fixture(name="session")
+def session_fixture(connection):
+    with _test_session(connection) as session:
+        yield session
+
+
+@pytest.fixture(scope="session")
+async def app_client():
+    # One in-process client for the whole run, requests go straight to the ASGI app. The
+    # app lifespan is not run, the tables come from setup_db.
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        yield client
+
+
 @pytest.fixture(name="client")
-def client_fixture():
-    # Override the dependency
+def client_fixture(app_client, connection):
+    # Override the database dependency
+    def override_get_session():
+        with _test_session(connection) as session:
+            yield session
+
     app.dependency_overrides[get_session] = override_get_session
-    with TestClient(app) as client:
-        yield client
+    yield app_client
     # Clean up overrides
     app.dependency_overrides.clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_auth_caches():
+    # cached users and tokens would otherwise outlive the rolled back rows they came from
+    main._user_cache.clear()
+    main._jwt_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def fast_password_hashing(monkeypatch):
+    # bcrypt cost doubles per round, the minimum keeps hashing out of the test profile
+    monkeypatch.setattr(main, "BCRYPT_ROUNDS", 4)
+    monkeypatch.setattr(main, "LEGACY_BCRYPT_ROUNDS", 4)
+
+
+# bcrypt.hashpw(b"testpass", bcrypt.gensalt(rounds=4)), generated once offline
+TESTPASS_HASH_COST4 = "$2b$04$uri49sZsmEU84JeF1X9d7.mDxsvB1Kzsh/HZ1UYy3GQBx0tNJBU.G"
+
+
+@pytest.fixture(scope="session")
+def precomputed_user():
+    # For tests that need an existing user but not the register path
+    return {"username": "testuser", "hashed_password": TESTPASS_HASH_COST4}
+
+
+@pytest.fixture
+def registered_user(session, precomputed_user):
+    # Existing user, inserted directly; its password is "testpass"
+    session.add(User(**precomputed_user))
+    session.commit()
+    return precomputed_user["username"]
+
+
+async def _login_headers(client, username):
+    await client.post(
+        "/users/register", json={"username": username, "password": "pass"}
+    )
+    login = await client.post(
+        "/users/login", data={"username": username, "password": "pass"}
+    )
+    token = login.json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.fixture
+async def auth_headers(client, request):
+    # Registered and logged in once per test, named after the test
+    return await _login_headers(client, request.node.name)
+
+
+@pytest.fixture
+async def auth_headers_2(client, request, auth_headers):
+    # A second user, always created after the first one
+    return await _login_headers(client, f"{request.node.name}_2")
+
+
+@pytest.fixture
+def owner_id(session, request, auth_headers):
+    # Id of the user behind auth_headers
+    return session.exec(select(User.id).where(User.username == request.node.name)).one()
+
+
+def seed_expenses(session, owner_id, rows):
+    # Insert test data directly, the endpoint itself is covered by test_create_and_get_expenses
+    expenses = [Expense.model_validate({**row, "owner_id": owner_id}) for row in rows]
+    session.add_all(expenses)
+    session.commit()
+    return expenses
+
+
+def seed_categories(session, descriptions):
+    # Returns the new category ids keyed by description
+    categories = [Category(description=description) for description in descriptions]
+    session.add_all(categories)
+    session.commit()
+    return {category.description: category.id for category in categories}
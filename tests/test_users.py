@@ -1,100 +1,145 @@
-from fastapi.testclient import TestClient
+from unittest.mock import AsyncMock
 
+import orjson
+import pytest
+from httpx import AsyncClient
+from sqlmodel import Session, select
 
-def test_register_user(client: TestClient):
+import main
+from models import User, UserRead
+
+
+async def test_register_user(client: AsyncClient, monkeypatch):
     # Test successful registration
-    response = client.post(
+    response = await client.post(
         "/users/register", json={"username": "testuser", "password": "testpass"}
     )
     assert response.status_code == 200
-    data = response.json()
-    assert data["username"] == "testuser"
-    assert "id" in data
-    assert "hashed_password" not in data
-
-    # Test duplicate registration
-    response = client.post(
+    # UserRead requires the id; it ignores extra keys, so check the raw body for the hash
+    user = UserRead.model_validate_json(response.content)
+    assert user.username == "testuser"
+    assert b"hashed_password" not in response.content
+
+    # Test duplicate registration, rejected before any password hashing
+    hash_password = AsyncMock()
+    monkeypatch.setattr(main, "get_password_hash", hash_password)
+    response = await client.post(
         "/users/register", json={"username": "testuser", "password": "testpass"}
     )
     assert response.status_code == 400
-    assert "Username already registered" in response.json()["detail"]
+    assert "Username already registered" in orjson.loads(response.content)["detail"]
+    hash_password.assert_not_called()
 
     # Test missing username
-    response = client.post("/users/register", json={"password": "testpass"})
+    response = await client.post("/users/register", json={"password": "testpass"})
     assert response.status_code == 422  # Unprocessable Entity
-    assert "username" in response.json()["detail"][0]["loc"]
-    assert "missing" in response.json()["detail"][0]["type"]
+    error = orjson.loads(response.content)["detail"][0]
+    assert "username" in error["loc"]
+    assert "missing" in error["type"]
 
     # Test missing password
-    response = client.post("/users/register", json={"username": "testuser"})
+    response = await client.post("/users/register", json={"username": "testuser"})
     assert response.status_code == 422  # Unprocessable Entity
-    assert "password" in response.json()["detail"][0]["loc"]
-    assert "missing" in response.json()["detail"][0]["type"]
+    error = orjson.loads(response.content)["detail"][0]
+    assert "password" in error["loc"]
+    assert "missing" in error["type"]
 
 
-def test_login_user(client: TestClient):
-    # Register first
-    client.post(
-        "/users/register", json={"username": "testuser", "password": "testpass"}
-    )
-
-    # Test valid login
-    response = client.post(
-        "/users/login", data={"username": "testuser", "password": "testpass"}
+async def test_login_user(client: AsyncClient, registered_user):
+    response = await client.post(
+        "/users/login", data={"username": registered_user, "password": "testpass"}
     )
     assert response.status_code == 200
-    data = response.json()
+    data = orjson.loads(response.content)
     assert "access_token" in data
     assert data["token_type"] == "bearer"
 
-    # Test invalid login - wrong password
-    response = client.post(
-        "/users/login", data={"username": "testuser", "password": "wrongpass"}
-    )
-    assert response.status_code == 401
-    assert "Incorrect username or password" in response.json()["detail"]
 
-    # Test invalid login - wrong username
-    response = client.post(
-        "/users/login", data={"username": "wronguser", "password": "testpass"}
+@pytest.mark.parametrize(
+    "username,password",
+    [("testuser", "wrongpass"), ("wronguser", "testpass")],
+    ids=["wrong_password", "wrong_username"],
+)
+async def test_login_invalid_credentials(
+    client: AsyncClient, registered_user, username, password
+):
+    response = await client.post(
+        "/users/login", data={"username": username, "password": password}
     )
     assert response.status_code == 401
-    assert "Incorrect username or password" in response.json()["detail"]
+    assert "Incorrect username or password" in orjson.loads(response.content)["detail"]
 
-    # Test missing username for login
-    response = client.post("/users/login", data={"password": "testpass"})
-    assert response.status_code == 422  # Unprocessable Entity
-    assert "username" in response.json()["detail"][0]["loc"]
-    assert "missing" in response.json()["detail"][0]["type"]
 
-    # Test missing password for login
-    response = client.post("/users/login", data={"username": "testuser"})
+@pytest.mark.parametrize(
+    "data,missing",
+    [({"password": "testpass"}, "username"), ({"username": "testuser"}, "password")],
+)
+async def test_login_missing_field(client: AsyncClient, data, missing):
+    response = await client.post("/users/login", data=data)
     assert response.status_code == 422  # Unprocessable Entity
-    assert "password" in response.json()["detail"][0]["loc"]
-    assert "missing" in response.json()["detail"][0]["type"]
+    error = orjson.loads(response.content)["detail"][0]
+    assert missing in error["loc"]
+    assert "missing" in error["type"]
 
 
-def test_read_users_me(client: TestClient):
-    # Register and login user
-    client.post("/users/register", json={"username": "me_user", "password": "me_pass"})
-    login = client.post(
-        "/users/login", data={"username": "me_user", "password": "me_pass"}
-    )
-    token = login.json()["access_token"]
-    headers = {"Authorization": f"Bearer {token}"}
-
+async def test_read_users_me(client: AsyncClient, auth_headers, request):
     # Test get current user successfully
-    response = client.get("/users/me", headers=headers)
+    response = await client.get("/users/me", headers=auth_headers)
     assert response.status_code == 200
-    me_data = response.json()
-    assert me_data["username"] == "me_user"
+    me_data = orjson.loads(response.content)
+    assert me_data["username"] == request.node.name
     assert "id" in me_data
+    # the cache keeps a frozen snapshot, not the session-bound ORM row
+    assert isinstance(main._user_cache[request.node.name], UserRead)
 
     # Test no token access
-    response_no_token = client.get("/users/me")
+    response_no_token = await client.get("/users/me")
     assert response_no_token.status_code == 401
 
     # Test invalid token
     headers_invalid_token = {"Authorization": "Bearer invalid_token"}
-    response_invalid_token = client.get("/users/me", headers=headers_invalid_token)
+    response_invalid_token = await client.get(
+        "/users/me", headers=headers_invalid_token
+    )
     assert response_invalid_token.status_code == 401
+
+
+async def test_login_rehashes_low_cost_password(
+    client: AsyncClient, session: Session, monkeypatch
+):
+    # Register with a cheap hash, then raise the configured cost
+    monkeypatch.setattr(main, "BCRYPT_ROUNDS", 4)
+    await client.post(
+        "/users/register", json={"username": "rehash_user", "password": "pass"}
+    )
+    monkeypatch.setattr(main, "BCRYPT_ROUNDS", 5)
+
+    response = await client.post(
+        "/users/login", data={"username": "rehash_user", "password": "pass"}
+    )
+    assert response.status_code == 200
+
+    user = session.exec(select(User).where(User.username == "rehash_user")).one()
+    assert user.hashed_password.startswith("$2b$05$")
+
+    # The upgraded hash still verifies
+    response = await client.post(
+        "/users/login", data={"username": "rehash_user", "password": "pass"}
+    )
+    assert response.status_code == 200
+
+
+async def test_login_unknown_user_uses_highest_stored_cost(
+    client: AsyncClient, monkeypatch
+):
+    # Legacy hashes cost more than the configured rounds, the dummy check must match them
+    monkeypatch.setattr(main, "LEGACY_BCRYPT_ROUNDS", 5)
+    verify_password = AsyncMock(return_value=False)
+    monkeypatch.setattr(main, "verify_password", verify_password)
+
+    response = await client.post(
+        "/users/login", data={"username": "nobody", "password": "pass"}
+    )
+    assert response.status_code == 401
+    dummy_hash = verify_password.await_args.args[1]
+    assert dummy_hash.startswith("$2b$05$")